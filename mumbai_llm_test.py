@@ -1,14 +1,17 @@
+import asyncio
+import httpx
 import ollama
 import csv
-import json
+import orjson
 import os
 import logging
 import sys
 import time
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Optional
-from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import queue
+import threading
+from collections import deque
 import psutil
 
 # Configure logging
@@ -22,13 +25,60 @@ logging.basicConfig(
 )
 
 # Configuration
+NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
 JSON_FILE = 'questions.json'
 OUTPUT_CSV = 'results/llm_results.csv'
 MODELS = ['phi3:latest', 'gemma:7b', 'llama3:latest', 'deepseek-llm:latest']  # Reordered: small to big
-MAX_WORKERS = min(2, os.cpu_count() or 1)  # Conservative
+MAX_WORKERS = NUM_PARALLEL  # Chat requests in flight per model; matches the server's per-model parallel slots
 RETRY_ATTEMPTS = 3
 RETRY_DELAY = 10
 WARMUP_TIMEOUT = 30
+CSV_BATCH_SIZE = 32  # Rows buffered before a writerows() + flush
+CSV_FLUSH_INTERVAL = 1.0  # Longest a finished row waits in the buffer before it is written
+MAX_CONCURRENT_MODELS = 2  # Model sweeps run side by side when memory allows
+PREWARM_FRACTION = 0.9  # Start loading the next model once this share of questions is done
+
+# Options that decide how Ollama loads a model; every call must send the same values or the
+# server reloads the model. num_thread is left to Ollama, which defaults to physical cores.
+RUNNER_OPTIONS = {"num_ctx": 2048}
+
+# One async client for the whole run; requests are multiplexed on the event loop instead of threads
+# and share a single keep-alive connection pool
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+CLIENT = ollama.AsyncClient(host=OLLAMA_HOST)
+
+# Prompt templates; the fixed preamble keeps a byte-identical prefix across questions
+PROMPT_EN = """Please answer the following question in English.
+Be concise and accurate in your response.
+Question: {}"""
+
+PROMPT_HI = """कृपया निम्नलिखित प्रश्न का उत्तर हिंदी में दें।
+उत्तर संक्षिप्त और सटीक दें।
+प्रश्न: {}"""
+
+class Result(NamedTuple):
+    """One answered question; the question dict is shared, not copied, until the writer builds the CSV row."""
+    question: Dict
+    model: str
+    response_en: str
+    response_hi: str
+    tokens_en: int
+    tokens_hi: int
+    timestamp: str
+
+_timestamp_cache = (0, "")
+
+def now_str() -> str:
+    """Return the current local time as a string, formatting at most once per second."""
+    global _timestamp_cache
+    t = int(time.time())
+    cached_t, cached_str = _timestamp_cache
+    if t != cached_t:
+        cached_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        _timestamp_cache = (t, cached_str)
+    return cached_str
 
 def check_system_resources():
     """Check available memory to avoid overloading."""
@@ -40,44 +90,86 @@ def check_system_resources():
 
 def load_questions(json_file: str) -> List[Dict]:
     try:
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            questions = []
-            for category, items in data['categorized_questions'].items():
-                for item in items:
-                    questions.append({
-                        "id": item["id"],
-                        "category": category,
-                        "english": item["text_en"],
-                        "hindi": item["text_hi"]
-                    })
-            logging.info(f"Loaded {len(questions)} questions from {json_file}")
-            return questions
+        with open(json_file, 'rb') as f:
+            categorized = orjson.loads(f.read())['categorized_questions']
+        questions = [
+            {
+                "id": item["id"],
+                "category": category,
+                "english": item["text_en"],
+                "hindi": item["text_hi"]
+            }
+            for category, items in categorized.items()
+            for item in items
+        ]
+        logging.info(f"Loaded {len(questions)} questions from {json_file}")
+        return questions
     except Exception as e:
         logging.error(f"Error loading questions: {str(e)}")
         sys.exit(1)
 
-def warm_up_model(model: str, max_retries: int = RETRY_ATTEMPTS) -> bool:
-    warmup_question = "What is Mumbai famous for? Answer in one sentence."
+async def is_model_loaded(model: str) -> bool:
+    """Return True if the Ollama server already has the model resident with RUNNER_OPTIONS."""
+    try:
+        running = (await CLIENT.ps()).get('models', [])
+    except Exception as e:
+        logging.debug(f"Failed to query running models: {e}")
+        return False
+    for m in running:
+        if model not in (m.get('model'), m.get('name')):
+            continue
+        # A copy loaded with another context size would be reloaded by the first chat; servers
+        # that do not report context_length cannot be checked, so fall through to the cheap probe
+        if m.get('context_length') == RUNNER_OPTIONS["num_ctx"]:
+            return True
+        logging.info(f"{model} is loaded with context_length={m.get('context_length')}, re-warming.")
+    return False
+
+async def warm_up_model(model: str, max_retries: int = RETRY_ATTEMPTS) -> bool:
+    if await is_model_loaded(model):
+        logging.info(f"{model} already loaded, skipping warm-up.")
+        return True
     for attempt in range(max_retries):
         try:
-            res = ollama.generate(
+            # A single-token probe is enough to force the model into memory
+            res = await CLIENT.generate(
                 model=model,
-                prompt=warmup_question,
-                options={"num_predict": 20, "timeout": WARMUP_TIMEOUT}
+                prompt=" ",
+                options={**RUNNER_OPTIONS, "num_predict": 1, "temperature": 0, "timeout": WARMUP_TIMEOUT},
+                keep_alive=KEEP_ALIVE
             )
-            if res.get("response"):
-                logging.info(f"{model} warm-up successful. Response: {res['response'][:50]}...")
+            if res.get("done"):
+                logging.info(f"{model} warm-up successful.")
                 return True
         except Exception as e:
             logging.warning(f"{model} warm-up failed ({attempt+1}/{max_retries}): {e}")
-            time.sleep(RETRY_DELAY)
+            await asyncio.sleep(RETRY_DELAY)
     logging.error(f"{model} failed to warm up after {max_retries} attempts.")
     return False
 
-def query_ollama(model: str, prompt: str, retries: int = RETRY_ATTEMPTS) -> Optional[str]:
+async def unload_model(model: str):
+    """Ask the server to release a model now instead of holding it for KEEP_ALIVE."""
+    try:
+        await CLIENT.generate(model=model, keep_alive=0)
+        logging.info(f"Unloaded {model}")
+    except Exception as e:
+        logging.warning(f"Failed to unload {model}: {e}")
+
+def is_transient_error(e: Exception) -> bool:
+    """Return True for failures worth retrying: server-side errors, throttling and transport problems."""
+    if isinstance(e, ollama.ResponseError):
+        # 4xx means the request itself is bad (unknown model, invalid options); retrying cannot help
+        return not 400 <= e.status_code < 500 or e.status_code == 429
+    return isinstance(e, (ConnectionError, httpx.TransportError))
+
+async def query_ollama(model: str, prompt: str, slots: asyncio.Semaphore,
+                       retries: int = RETRY_ATTEMPTS) -> Tuple[Optional[str], int]:
+    """Stream a chat completion, returning the full text and the model's generated token count.
+
+    Each attempt holds one of the model's request slots; retry back-off does not.
+    """
     options = {
-        "num_ctx": 2048,
+        **RUNNER_OPTIONS,
         "temperature": 0.3,
         "seed": 42,
         "top_k": 40,
@@ -86,90 +178,116 @@ def query_ollama(model: str, prompt: str, retries: int = RETRY_ATTEMPTS) -> Opti
     }
     for attempt in range(retries):
         try:
-            start_time = time.time()
-            response = ollama.chat(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                options=options
-            )
+            async with slots:
+                start_time = time.time()
+                parts = []
+                tokens = None
+                async for chunk in await CLIENT.chat(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    options=options,
+                    keep_alive=KEEP_ALIVE,
+                    stream=True
+                ):
+                    parts.append(chunk['message']['content'])
+                    if chunk.get('done'):
+                        tokens = chunk.get('eval_count')
+            content = "".join(parts)
             elapsed = time.time() - start_time
             logging.debug(f"{model} response time: {elapsed:.2f}s")
-            return response['message']['content']
+            # Fall back to a word count if the server omits eval_count
+            return content, tokens if tokens is not None else len(content.split())
         except Exception as e:
+            if not is_transient_error(e):
+                logging.error(f"{model} query failed with a non-retryable error: {e}")
+                return None, 0
             logging.warning(f"{model} query failed (attempt {attempt+1}/{retries}): {e}")
-            time.sleep(RETRY_DELAY * (attempt + 1))
-    return None
+            if attempt + 1 < retries:
+                await asyncio.sleep(RETRY_DELAY * (attempt + 1))
+    return None, 0
 
-def process_question(model: str, question: Dict) -> Dict:
+async def process_question(model: str, question: Dict, slots: asyncio.Semaphore) -> Result:
     try:
-        prompt_en = f"""Please answer the following question in English.
-Be concise and accurate in your response.
-Question: {question['english']}"""
+        prompt_en = PROMPT_EN.format(question['english'])
+        prompt_hi = PROMPT_HI.format(question['hindi'])
 
-        prompt_hi = f"""कृपया निम्नलिखित प्रश्न का उत्तर हिंदी में दें।
-उत्तर संक्षिप्त और सटीक दें।
-प्रश्न: {question['hindi']}"""
-
-        res_en = query_ollama(model, prompt_en)
-        res_hi = query_ollama(model, prompt_hi)
-
-        return {
-            "id": question["id"],
-            "category": question["category"],
-            "english": question["english"],
-            "hindi": question["hindi"],
-            "model": model,
-            "response_en": res_en or "ERROR",
-            "response_hi": res_hi or "ERROR",
-            "tokens_en": len(res_en.split()) if res_en else 0,
-            "tokens_hi": len(res_hi.split()) if res_hi else 0,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
+        # Both languages go out together so the question costs one round-trip, not two
+        (res_en, tokens_en), (res_hi, tokens_hi) = await asyncio.gather(
+            query_ollama(model, prompt_en, slots),
+            query_ollama(model, prompt_hi, slots)
+        )
+
+        return Result(question, model, res_en or "ERROR", res_hi or "ERROR", tokens_en, tokens_hi, now_str())
     except Exception as e:
         logging.error(f"Failed question {question['id']} for {model}: {e}")
-        return {
-            "id": question["id"],
-            "category": question["category"],
-            "english": question["english"],
-            "hindi": question["hindi"],
-            "model": model,
-            "response_en": "ERROR",
-            "response_hi": "ERROR",
-            "tokens_en": 0,
-            "tokens_hi": 0,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-
-def process_model_questions(model: str, questions: List[Dict]):
-    lock = Lock()
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(process_question, model, question) for question in questions]
-        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Processing {model}"):
-            result = future.result()
-            with lock:
-                with open(OUTPUT_CSV, 'a', newline='', encoding='utf-8-sig') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([
-                        result["id"], result["category"],
-                        result["english"], result["hindi"],
-                        result["model"],
-                        result["response_en"], result["response_hi"],
-                        result["tokens_en"], result["tokens_hi"],
-                        result["timestamp"]
-                    ])
-                    f.flush()
-
-def process_models(questions: List[Dict]):
+        return Result(question, model, "ERROR", "ERROR", 0, 0, now_str())
+
+def csv_writer_worker(row_queue: queue.Queue, f):
+    """Append queued results to an open CSV file in batches until a None sentinel arrives."""
+    writer = csv.writer(f)
+    batch = []
+    deadline = None
+    while True:
+        # Block until the first row; after that wait only until the batch's deadline
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            result = row_queue.get(timeout=timeout)
+        except queue.Empty:
+            result = ()
+        if result is None:
+            break
+        if result:
+            if not batch:
+                deadline = time.monotonic() + CSV_FLUSH_INTERVAL
+            question = result.question
+            batch.append((
+                question["id"], question["category"],
+                question["english"], question["hindi"],
+                result.model,
+                result.response_en, result.response_hi,
+                result.tokens_en, result.tokens_hi,
+                result.timestamp
+            ))
+        if batch and (len(batch) >= CSV_BATCH_SIZE or time.monotonic() >= deadline):
+            writer.writerows(batch)
+            f.flush()
+            batch.clear()
+            deadline = None
+    if batch:
+        writer.writerows(batch)
+        f.flush()
+
+async def process_model_questions(model: str, questions: List[Dict], row_queue: queue.Queue,
+                                  on_nearly_done: Optional[Callable[[], None]] = None):
+    """Run all questions against a model, calling on_nearly_done once near the end."""
+    slots = asyncio.Semaphore(MAX_WORKERS)
+
+    # No task list is kept: as_completed drops each finished task, so a result lives only until it is written
+    total = len(questions)
+    total_tokens_en = total_tokens_hi = 0
+    completed = asyncio.as_completed([process_question(model, question, slots) for question in questions])
+    for done, next_result in enumerate(tqdm(completed, total=total, desc=f"Processing {model}"), 1):
+        if on_nearly_done is not None and done / total > PREWARM_FRACTION:
+            on_nearly_done()
+            on_nearly_done = None
+        result = await next_result
+        total_tokens_en += result.tokens_en
+        total_tokens_hi += result.tokens_hi
+        row_queue.put(result)
+    logging.info(f"{model} finished {total} questions ({total_tokens_en} EN / {total_tokens_hi} HI tokens)")
+
+async def process_models(questions: List[Dict]):
     if not check_system_resources():
         logging.warning("Continuing despite low memory, but performance may be impacted.")
 
     try:
-        response = ollama.list()
+        response = await CLIENT.list()
         logging.info(f"Ollama API response: {response}")
         model_key = 'model' if 'model' in response.get('models', [{}])[0] else 'name'
         available_models = [model[model_key] for model in response.get('models', [])]
+        model_sizes = {model[model_key]: model.get('size') or 0 for model in response.get('models', [])}
     except Exception as e:
-        logging.error(f"Failed to list models: {str(e)}. Ensure Ollama server is running.")
+        logging.error(f"Failed to list models: {str(e)}. Ensure Ollama server is running at {OLLAMA_HOST}.")
         sys.exit(1)
 
     # Sort models: smallest to biggest
@@ -196,14 +314,76 @@ def process_models(questions: List[Dict]):
             "Timestamp"
         ])
 
-    for model in valid_models:
-        logging.info(f"Starting warm-up and processing for model: {model}")
-        if not warm_up_model(model):
-            logging.error(f"Skipping {model} due to warm-up failure.")
-            continue
-        process_model_questions(model, questions)
+        row_queue = queue.Queue()
+        writer_thread = threading.Thread(target=csv_writer_worker, args=(row_queue, f), daemon=True)
+        writer_thread.start()
+        # Only overlap model sweeps if the largest models fit in memory together. Pre-warming (which
+        # would add a third resident model) is serial-only, and a finished model is unloaded only when
+        # the next one would not fit alongside it; otherwise it keeps its KEEP_ALIVE residency
+        largest = sorted((model_sizes.get(m, 0) for m in valid_models), reverse=True)[:MAX_CONCURRENT_MODELS]
+        required_gb = sum(largest) / (1024 ** 3)
+        available_gb = psutil.virtual_memory().available / (1024 ** 3)
+        concurrent_models = MAX_CONCURRENT_MODELS if available_gb >= required_gb else 1
+        logging.info(f"Running {concurrent_models} model(s) at a time "
+                     f"({available_gb:.2f} GB available, {required_gb:.2f} GB needed for {MAX_CONCURRENT_MODELS})")
+
+        pending = deque(valid_models)
+        prewarm_tasks: Dict[str, asyncio.Task] = {}
+
+        def fits_in_free_memory(model: str) -> bool:
+            free_gb = psutil.virtual_memory().available / (1024 ** 3)
+            needed_gb = model_sizes.get(model, 0) / (1024 ** 3)
+            if needed_gb > free_gb:
+                logging.info(f"{model} does not fit alongside resident models ({needed_gb:.2f} GB needed, "
+                             f"{free_gb:.2f} GB free)")
+                return False
+            return True
+
+        def should_unload() -> bool:
+            if not pending:
+                return False  # Nothing else will load; leave the model resident for the next run
+            if concurrent_models > 1:
+                return True  # The memory check only covers two resident models
+            # A pre-warmed next model is already resident; otherwise it must fit next to this one
+            return pending[0] not in prewarm_tasks and not fits_in_free_memory(pending[0])
+
+        def prewarm_next():
+            next_model = next((m for m in pending if m not in prewarm_tasks), None)
+            # The current model is still resident, so the next one has to fit in what is left
+            if next_model is None or not fits_in_free_memory(next_model):
+                return
+            logging.info(f"Pre-warming {next_model}")
+            prewarm_tasks[next_model] = asyncio.ensure_future(warm_up_model(next_model))
+
+        async def model_worker():
+            while pending:
+                model = pending.popleft()
+                logging.info(f"Starting warm-up and processing for model: {model}")
+                if model in prewarm_tasks:
+                    await prewarm_tasks.pop(model)
+                if not await warm_up_model(model):
+                    logging.error(f"Skipping {model} due to warm-up failure.")
+                    continue
+                try:
+                    logging.info(f"Resident models: {await CLIENT.ps()}")
+                except Exception as e:
+                    logging.warning(f"Failed to query running models: {e}")
+                await process_model_questions(model, questions, row_queue,
+                                              prewarm_next if concurrent_models == 1 else None)
+                if should_unload():
+                    await unload_model(model)
+
+        try:
+            await asyncio.gather(*(model_worker() for _ in range(min(concurrent_models, len(valid_models)))))
+        finally:
+            row_queue.put(None)
+            writer_thread.join()
 
 if __name__ == "__main__":
+    # Server-side concurrency and residency; only honoured by an Ollama server started from this environment
+    os.environ.setdefault("OLLAMA_NUM_PARALLEL", str(NUM_PARALLEL))
+    os.environ.setdefault("OLLAMA_KEEP_ALIVE", KEEP_ALIVE)
+
     logging.info("="*60)
     logging.info(f"LLM Evaluation - Models: {', '.join(MODELS)}")
     logging.info("="*60)
@@ -219,7 +399,7 @@ if __name__ == "__main__":
 
     start_time = time.time()
     try:
-        process_models(questions)
+        asyncio.run(process_models(questions))
     except Exception as e:
         logging.error(f"Processing failed: {str(e)}")
         sys.exit(1)